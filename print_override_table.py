@@ -6,15 +6,12 @@ import requests
 
 REPO_DIR = Path(__file__).resolve().parent
 ENV_PATH = REPO_DIR / ".env.local"
+_ENV_LINE_RE = re.compile(r"^(?![ \t]*#)([^=\n]*)=([^\n]*)$", re.M)  # KEY=value lines, "#" lines skipped
+_COMMENT_RE  = re.compile(r"\s+#.*$")  # trailing inline comment
 
 def parse_env_file(path: Path):
-    env = {}
-    for raw in path.read_text(encoding="utf-8").splitlines():
-        line = raw.strip()
-        if not line or line.startswith("#") or "=" not in line: continue
-        k, v = line.split("=", 1)
-        env[k.strip()] = re.sub(r"\s+#.*$", "", v).strip().strip('"').strip("'")
-    return env
+    return {k.strip(): _COMMENT_RE.sub("", v).strip().strip('"').strip("'")
+            for k, v in _ENV_LINE_RE.findall(path.read_text(encoding="utf-8"))}
 
 def fetch_all(base, table, token, view=None, fields=None, limit=10):
     url = f"https://api.airtable.com/v0/{base}/{quote(table, safe='')}"
@@ -1,10 +1,21 @@
 #!/usr/bin/env python3
 # push_csv.py — commit/push CSV to GitHub, then sync to Airtable with linked records (Cities, Configs → Rents)
 
-import os, re, sys, csv, json, subprocess, requests, argparse
+import os, re, sys, csv, time, shutil, filecmp, threading, subprocess, requests, argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
+from types import MappingProxyType
 from datetime import datetime
 from urllib.parse import quote
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # optional: faster (de)serialization of Airtable payloads
+except ImportError:
+    orjson = None
 
 # ---------------------------
 # Paths & constants
@@ -18,17 +29,16 @@ SNAPSHOT_NAME_FMT = "panama_rent_averages_{yyyy}-{mm}.csv"  # e.g., ..._2025-10.
 # ---------------------------
 # Env handling
 # ---------------------------
+_ENV_LINE_RE = re.compile(r"^(?![ \t]*#)([^=\n]*)=([^\n]*)$", re.M)  # KEY=value lines, "#" lines skipped
+_COMMENT_RE  = re.compile(r"\s+#.*$")  # trailing inline comment
+
+@lru_cache(maxsize=1)
 def parse_env_file(path: Path):
+    # cached, so hand out a read-only view; get_env() copies it
     if not path.exists():
-        return {}
-    env = {}
-    for raw in path.read_text(encoding="utf-8").splitlines():
-        line = raw.strip()
-        if not line or line.startswith("#") or "=" not in line:
-            continue
-        k, v = line.split("=", 1)
-        env[k.strip()] = re.sub(r"\s+#.*$", "", v).strip().strip('"').strip("'")
-    return env
+        return MappingProxyType({})
+    return MappingProxyType({k.strip(): _COMMENT_RE.sub("", v).strip().strip('"').strip("'")
+                             for k, v in _ENV_LINE_RE.findall(path.read_text(encoding="utf-8"))})
 
 def get_env():
     file_env = parse_env_file(ENV_PATH)
@@ -54,30 +64,46 @@ def build_csv_if_needed(skip_build: bool) -> None:
         "Date","City/Neighborhood","Configuration","Average Price (USD)",
         "Utilities","Groceries","Internet","Cell Phone","Dining","Entertainment","Travel"
     ]
-    with open(CSV_OUT, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(headers)
+    # plain header names (no commas/quotes), so no csv.writer quoting is needed
+    CSV_OUT.write_bytes((",".join(headers) + "\r\n").encode("utf-8"))
+
+def iter_csv_columns(path: Path, columns):
+    """Stream the CSV, yielding a tuple of the named columns per row ("" when missing)."""
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        idx = [header.index(c) if c in header else None for c in columns]
+        for row in reader:
+            if not row:
+                continue
+            yield tuple(row[i] if i is not None and i < len(row) else "" for i in idx)
 
 # ---------------------------
 # Snapshot
 # ---------------------------
 def write_monthly_snapshot(force_snapshot: bool) -> None:
-    yyyy = datetime.now().strftime("%Y")
-    mm   = datetime.now().strftime("%m")
+    now = datetime.now()
+    yyyy, mm = f"{now.year:04d}", f"{now.month:02d}"
     snap_name = SNAPSHOT_NAME_FMT.format(yyyy=yyyy, mm=mm)
     snap_path = SNAPSHOT_DIR / snap_name
     if snap_path.exists() and not force_snapshot:
         print(f"ℹ️ Snapshot exists, skipping: {snap_name} (use --force-snapshot to overwrite)")
         return
-    data = CSV_OUT.read_bytes()
-    snap_path.write_bytes(data)
+    # size check first, then byte compare; leaves the file (and its mtime) alone on no-op reruns
+    if snap_path.exists() and filecmp.cmp(CSV_OUT, snap_path, shallow=False):
+        print(f"ℹ️ Snapshot already matches CSV, skipping: {snap_name}")
+        return
+    shutil.copyfile(CSV_OUT, snap_path)  # kernel-side copy, no round-trip through Python
     print(f"✅ Wrote snapshot: {snap_path}")
 
 # ---------------------------
 # Git helpers
 # ---------------------------
+# absolute git path + "-C" instead of cwd= lets subprocess use posix_spawn rather than fork+exec
+GIT = [shutil.which("git") or "git", "-C", str(REPO_DIR)]
+
 def run(cmd, cwd=None, check=True):
-    res = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True, shell=False)
+    res = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True, shell=False, close_fds=False)
     if check and res.returncode != 0:
         print("❌ Command failed:", " ".join(cmd))
         print(res.stdout)
@@ -86,48 +112,130 @@ def run(cmd, cwd=None, check=True):
     return res
 
 def ensure_git_setup():
-    run(["git", "--version"])
-    run(["git", "rev-parse", "--is-inside-work-tree"], cwd=str(REPO_DIR))
+    # one process checks both that git runs and that REPO_DIR is a work tree
+    run([*GIT, "rev-parse", "--is-inside-work-tree"])
 
 def git_commit_and_push(commit_msg: str):
-    run(["git", "add", str(CSV_OUT)], cwd=str(REPO_DIR))
-    for p in SNAPSHOT_DIR.glob("panama_rent_averages_*.csv"):
-        run(["git", "add", str(p)], cwd=str(REPO_DIR))
-    res = subprocess.run(["git", "commit", "-m", commit_msg], cwd=str(REPO_DIR), capture_output=True, text=True)
-    if "nothing to commit" in (res.stdout + res.stderr).lower():
+    snapshots = [e.path for e in os.scandir(SNAPSHOT_DIR)
+                 if e.name.startswith("panama_rent_averages_") and e.name.endswith(".csv") and e.is_file()]
+    paths = [str(CSV_OUT), *snapshots]
+    # one porcelain check covers staged, unstaged and untracked changes; idle runs skip add + commit
+    if not run([*GIT, "status", "--porcelain", "--", *paths]).stdout.strip():
         print("ℹ️ Nothing to commit.")
     else:
+        run([*GIT, "add", "--", *paths])
+        res = run([*GIT, "commit", "-m", commit_msg], check=False)
         print(res.stdout.strip() or res.stderr.strip())
-    run(["git", "push", "origin", "HEAD"], cwd=str(REPO_DIR))
+    # skip the network round-trip when HEAD already matches its upstream tracking ref
+    res = run([*GIT, "rev-parse", "HEAD", "@{u}"], check=False)
+    shas = res.stdout.split()
+    if res.returncode == 0 and len(shas) == 2 and shas[0] == shas[1]:
+        print("ℹ️ Already up to date with upstream; skipping push.")
+        return
+    run([*GIT, "push", "--atomic", "origin", "HEAD"])
     print("🚀 Pushed to origin.")
 
 # ---------------------------
 # Airtable helpers
 # ---------------------------
+# one keep-alive session for every Airtable call (reuses the TLS connection)
+SESSION = requests.Session()
+SESSION.headers.update({"Accept": "application/json"})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=16,
+    # PATCH by record id is idempotent, so batch updates are retried too (POST creates are not)
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False,
+                      allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"PATCH"}),
+))
+
+AT_BATCH_SIZE = 10  # Airtable's max records per create/update request
+AT_MAX_RPS    = 5   # Airtable's per-base request rate limit
+AT_WORKERS    = 5   # concurrent batch requests
+_FORMULA_ESCAPES = str.maketrans({"\\": "\\\\", "'": "\\'"})  # formula strings escape with backslash
+
 def at_base_url(base, table): return f"https://api.airtable.com/v0/{base}/{quote(str(table), safe='')}"
 def h_json(token): return {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
 def h_get(token):  return {"Authorization": f"Bearer {token}", "Accept": "application/json"}
+def at_quote(s):   return "'" + str(s).translate(_FORMULA_ESCAPES) + "'"
+def at_json(r):    return orjson.loads(r.content) if orjson else r.json()
+def at_body(obj):  return {"data": orjson.dumps(obj)} if orjson else {"json": obj}  # request body kwargs
+
+_rate_lock = threading.Lock()
+_next_slot = 0.0
+
+def at_throttle():
+    """Block until the next request slot, spacing calls 1/AT_MAX_RPS apart across threads."""
+    global _next_slot
+    with _rate_lock:
+        now = time.monotonic()
+        wait = _next_slot - now
+        _next_slot = max(now, _next_slot) + 1.0 / AT_MAX_RPS
+    if wait > 0:
+        time.sleep(wait)
+
+DATE_FORMATS = ("%m/%d/%Y","%Y-%m-%d","%m/%d/%y")
+_ISO_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_last_date_fmt = DATE_FORMATS[0]  # CSV dates share one format; try the last winner first
 
 def fmt_date(val: str) -> str:
+    global _last_date_fmt
     if not val: return val
-    for fmt in ("%m/%d/%Y","%Y-%m-%d","%m/%d/%y"):
-        try: return datetime.strptime(val, fmt).strftime("%Y-%m-%d")
-        except: pass
+    if _ISO_DATE_RE.fullmatch(val): return val
+    for fmt in (_last_date_fmt, *DATE_FORMATS):
+        try: parsed = datetime.strptime(val, fmt)
+        except ValueError: continue
+        _last_date_fmt = fmt
+        return parsed.strftime("%Y-%m-%d")
     return val
 
 def to_float(v):
     try: return float(str(v).replace(",", ""))
     except: return v
 
+def same_value(a, b) -> bool:
+    """Equality for Airtable vs CSV values, with a small tolerance for numbers."""
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return abs(a - b) < 1e-6
+    return a == b
+
+def fetch_all_records(token, base, table, fields=None, optional_fields=()):
+    """Fetch every record of a table (paginated, 100 per page); retry once without optional fields."""
+    url = at_base_url(base, table)
+    params = {"pageSize": 100}
+    if fields:
+        params["fields[]"] = [*fields, *optional_fields]
+    out = []
+    while True:
+        r = SESSION.get(url, headers=h_get(token), params=params, timeout=30)
+        if r.status_code == 422 and optional_fields and fields and not out:
+            # fallback without optional fields (unknown field names are rejected)
+            params["fields[]"], optional_fields = list(fields), ()
+            continue
+        if r.status_code >= 300:
+            raise RuntimeError(f"Fetch error [{table}]: {r.status_code} {r.text}")
+        data = at_json(r)
+        out.extend(data.get("records", []))
+        if not data.get("offset"):
+            return out
+        params["offset"] = data["offset"]
+
+def index_by_primary(token, base, table, primary_field):
+    """Return {primary field text: record id} for every record in a (small) table."""
+    index = {}
+    for rec in fetch_all_records(token, base, table, fields=[primary_field]):
+        name = rec.get("fields", {}).get(primary_field)
+        if name:
+            index.setdefault(name, rec["id"])
+    return index
+
 def find_record_id_by_name(token, base, table, primary_field, name):
     """Find a record by its primary field text equal to name. Return record id or None."""
     url = at_base_url(base, table)
-    name_safe = (name or "").replace("'", "''")
-    formula = f"{{{primary_field}}}='{name_safe}'"
-    r = requests.get(url, headers=h_get(token), params={"maxRecords": 1, "filterByFormula": formula}, timeout=30)
+    formula = f"{{{primary_field}}}={at_quote(name or '')}"
+    r = SESSION.get(url, headers=h_get(token), params={"maxRecords": 1, "filterByFormula": formula}, timeout=30)
     if r.status_code >= 300:
         raise RuntimeError(f"Lookup error [{table}]: {r.status_code} {r.text}")
-    recs = r.json().get("records", [])
+    recs = at_json(r).get("records", [])
     return recs[0]["id"] if recs else None
 
 def create_record_by_name(token, base, table, primary_field, name, extra_fields=None):
@@ -136,10 +244,26 @@ def create_record_by_name(token, base, table, primary_field, name, extra_fields=
     fields = {primary_field: name}
     if extra_fields:
         fields.update(extra_fields)
-    r = requests.post(url, headers=h_json(token), data=json.dumps({"fields": fields, "typecast": True}), timeout=30)
+    r = SESSION.post(url, headers=h_json(token), **at_body({"fields": fields, "typecast": True}), timeout=30)
     if r.status_code >= 300:
         raise RuntimeError(f"Create error [{table}]: {r.status_code} {r.text}")
-    return r.json()["id"]
+    return at_json(r)["id"]
+
+def write_records_batch(token, base, table, records, method="PATCH", optional_fields=()):
+    """POST (create) or PATCH (update) up to AT_BATCH_SIZE records; retry once without optional fields. Return True on success."""
+    url = at_base_url(base, table)
+    at_throttle()
+    r = SESSION.request(method, url, headers=h_json(token), **at_body({"records": records, "typecast": True}), timeout=30)
+    if r.status_code >= 300 and optional_fields:
+        # fallback without optional fields
+        minimal = [dict(rec, fields={k: v for k, v in rec["fields"].items() if k not in optional_fields})
+                   for rec in records]
+        at_throttle()
+        r = SESSION.request(method, url, headers=h_json(token), **at_body({"records": minimal, "typecast": True}), timeout=30)
+    if r.status_code >= 300:
+        print("❌ Update error:" if method == "PATCH" else "❌ Create error:", r.status_code, r.text)
+        return False
+    return True
 
 def get_or_create_linked(token, base, table, primary_field, name, extra_fields=None):
     """Return record id in linked table; create it if missing."""
@@ -176,30 +300,52 @@ def airtable_sync_linked(env: dict) -> None:
     F_CURR   = "currency"         # text (optional)
     F_ACTIVE = "active"           # checkbox (optional)
 
-    # cache for lookups to reduce API calls
-    city_cache = {}
-    config_cache = {}
-
-    # load CSV
-    with open(CSV_OUT, newline="", encoding="utf-8") as f:
-        rows = list(csv.DictReader(f))
+    # stream CSV rows (only the columns we sync); skip all Airtable calls for an empty CSV
+    csv_columns = ("City/Neighborhood", "Configuration", "Date", "Average Price (USD)")
+    rows = iter_csv_columns(CSV_OUT, csv_columns)
+    first = next(rows, None)
+    if first is None:
+        print(f"ℹ️ Skipping Airtable sync: no data rows in {CSV_OUT}")
+        return
+    rows = chain([first], rows)
+
+    # list Cities/Configs and index existing Rents once instead of one filterByFormula lookup per name/row
+    # (the three listings are independent, so they are fetched concurrently)
+    try:
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            city_job   = pool.submit(index_by_primary, token, base, cities_table, CITY_PRIMARY)
+            config_job = pool.submit(index_by_primary, token, base, configs_table, CONFIG_PRIMARY)
+            rents_job  = pool.submit(fetch_all_records, token, base, rents_table,
+                                     fields=[F_CITY, F_CONFIG, F_DATE, F_PRICE], optional_fields=[F_CURR, F_ACTIVE])
+            city_cache, config_cache, existing = city_job.result(), config_job.result(), rents_job.result()
+    except Exception as e:
+        print("❌ Prefetch error:", repr(e))
+        return
+    rents_index = {}   # (city id, config id, date) -> (record id, current fields)
+    for rec in existing:
+        f = rec.get("fields", {})
+        cities, configs = f.get(F_CITY) or [None], f.get(F_CONFIG) or [None]
+        rents_index.setdefault((cities[0], configs[0], f.get(F_DATE)), (rec["id"], f))
 
-    rents_url = at_base_url(base, rents_table)
-    total = len(rows)
+    total = 0
     updated = 0
     created = 0
+    unchanged = 0
     failures = 0
+    pending_updates = {}
+    pending_creates = {}
 
-    for r in rows:
-        city_name  = (r.get("City/Neighborhood") or "").strip()
-        cfg_label  = (r.get("Configuration") or "").strip()
-        eff_date   = fmt_date(r.get("Date") or "")
-        price_val  = to_float(r.get("Average Price (USD)"))
+    for city_name, cfg_label, raw_date, raw_price in rows:
+        total += 1
+        city_name  = city_name.strip()
+        cfg_label  = cfg_label.strip()
+        eff_date   = fmt_date(raw_date)
+        price_val  = to_float(raw_price)
 
         if not (city_name and cfg_label and eff_date):
             continue
 
-        # --- ensure linked City & Config exist, get their record IDs
+        # --- ensure linked City & Config exist, get their record IDs (lookups only for names not prefetched)
         try:
             if city_name not in city_cache:
                 city_cache[city_name] = get_or_create_linked(token, base, cities_table, CITY_PRIMARY, city_name)
@@ -213,75 +359,54 @@ def airtable_sync_linked(env: dict) -> None:
             failures += 1
             continue
 
-        # --- find existing Rents record (match by linked names + date)
-        # We can match by the *display* text of linked fields using ARRAYJOIN in formula.
-        safe_city = city_name.replace("'", "''")
-        safe_cfg  = cfg_label.replace("'", "''")
-        formula = (
-            f"AND("
-            f"ARRAYJOIN({{{F_CITY}}})='{safe_city}',"
-            f"ARRAYJOIN({{{F_CONFIG}}})='{safe_cfg}',"
-            f"{{{F_DATE}}}='{eff_date}'"
-            f")"
-        )
-
-        try:
-            search = requests.get(
-                rents_url, headers=h_get(token),
-                params={"maxRecords": 1, "filterByFormula": formula},
-                timeout=30
-            )
-            if search.status_code >= 300:
-                print("❌ Lookup error:", search.status_code, search.text)
-                failures += 1
+        # --- queue UPDATE for an existing Rents record (match by linked record IDs + date), else CREATE
+        fields_payload = {
+            F_CITY:   [{"id": city_id}],
+            F_CONFIG: [{"id": config_id}],
+            F_DATE:    eff_date,
+            F_PRICE:   price_val,
+        }
+        # optional defaults if present in schema
+        fields_payload[F_CURR] = "USD"
+        fields_payload[F_ACTIVE] = True
+
+        key = (city_id, config_id, eff_date)
+        if key in rents_index:
+            rec_id, current = rents_index[key]
+            # a repeated CSV row replaces the earlier one, for updates as for creates
+            if same_value(current.get(F_PRICE), price_val) and current.get(F_CURR) == "USD" and current.get(F_ACTIVE) is True:
+                pending_updates.pop(rec_id, None)
+                unchanged += 1  # already up to date; no PATCH needed
                 continue
-
-            recs = search.json().get("records", [])
-            fields_payload = {
-                F_CITY:   [{"id": city_id}],
-                F_CONFIG: [{"id": config_id}],
-                F_DATE:    eff_date,
-                F_PRICE:   price_val,
-            }
-            # optional defaults if present in schema
-            fields_payload[F_CURR] = "USD"
-            fields_payload[F_ACTIVE] = True
-
-            if recs:
-                # UPDATE existing
-                rec_id = recs[0]["id"]
-                r_patch = requests.patch(f"{rents_url}/{rec_id}", headers=h_json(token),
-                                         data=json.dumps({"fields": fields_payload, "typecast": True}), timeout=30)
-                if r_patch.status_code >= 300:
-                    # fallback without optional fields
-                    minimal = {F_CITY: [{"id": city_id}], F_CONFIG: [{"id": config_id}], F_DATE: eff_date, F_PRICE: price_val}
-                    r_patch2 = requests.patch(f"{rents_url}/{rec_id}", headers=h_json(token),
-                                              data=json.dumps({"fields": minimal, "typecast": True}), timeout=30)
-                    if r_patch2.status_code >= 300:
-                        print("❌ Update error:", r_patch2.status_code, r_patch2.text)
-                        failures += 1
-                        continue
-                updated += 1
+            pending_updates[rec_id] = {"id": rec_id, "fields": fields_payload}
+        else:
+            pending_creates[key] = {"fields": fields_payload}
+
+    # --- send queued writes AT_BATCH_SIZE per request, AT_WORKERS in flight (rate-limited)
+    updates = list(pending_updates.values())
+    creates = list(pending_creates.values())
+    jobs = [("PATCH", updates[i:i + AT_BATCH_SIZE]) for i in range(0, len(updates), AT_BATCH_SIZE)]
+    jobs += [("POST", creates[i:i + AT_BATCH_SIZE]) for i in range(0, len(creates), AT_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=AT_WORKERS) as pool:
+        futures = {
+            pool.submit(write_records_batch, token, base, rents_table, batch, method, (F_CURR, F_ACTIVE)): (method, batch)
+            for method, batch in jobs
+        }
+        for fut in as_completed(futures):
+            method, batch = futures[fut]
+            try:
+                ok = fut.result()
+            except Exception as e:
+                print("❌ Exception during create/update:", repr(e))
+                ok = False
+            if not ok:
+                failures += len(batch)
+            elif method == "PATCH":
+                updated += len(batch)
             else:
-                # CREATE new
-                r_post = requests.post(rents_url, headers=h_json(token),
-                                       data=json.dumps({"fields": fields_payload, "typecast": True}), timeout=30)
-                if r_post.status_code >= 300:
-                    # fallback without optional fields
-                    minimal = {F_CITY: [{"id": city_id}], F_CONFIG: [{"id": config_id}], F_DATE: eff_date, F_PRICE: price_val}
-                    r_post2 = requests.post(rents_url, headers=h_json(token),
-                                            data=json.dumps({"fields": minimal, "typecast": True}), timeout=30)
-                    if r_post2.status_code >= 300:
-                        print("❌ Create error:", r_post2.status_code, r_post2.text)
-                        failures += 1
-                        continue
-                created += 1
-
-        except Exception as e:
-            print("❌ Exception during create/update:", repr(e))
-            failures += 1
+                created += len(batch)
 
-    print(f"✅ Airtable sync complete. Updated: {updated} | Created: {created} | Failures: {failures} | Total CSV rows: {total}")
+    print(f"✅ Airtable sync complete. Updated: {updated} | Created: {created} | Unchanged: {unchanged} | Failures: {failures} | Total CSV rows: {total}")
 
 # ---------------------------
 # Main
@@ -304,16 +429,18 @@ def main():
     # 2) Snapshot (monthly)
     write_monthly_snapshot(force_snapshot=args.force_snapshot)
 
-    # 3) Git push
-    ensure_git_setup()
-    git_commit_and_push(args.commit_msg)
-
-    # 4) Airtable sync (linked records)
-    if not args.skip_airtable:
-        print("↗️  Syncing CSV to Airtable (Cities/Configs → Rents)…")
-        airtable_sync_linked(env)
-    else:
-        print("⏭️  Skipping Airtable sync (per flag).")
+    # 3) Git push and 4) Airtable sync only read the CSV on disk, so overlap the two network steps
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        git_job = pool.submit(lambda: (ensure_git_setup(), git_commit_and_push(args.commit_msg)))
+        if not args.skip_airtable:
+            print("↗️  Syncing CSV to Airtable (Cities/Configs → Rents)…")
+            airtable_job = pool.submit(airtable_sync_linked, env)
+        else:
+            print("⏭️  Skipping Airtable sync (per flag).")
+            airtable_job = None
+        git_job.result()
+        if airtable_job:
+            airtable_job.result()
 
 if __name__ == "__main__":
     main()